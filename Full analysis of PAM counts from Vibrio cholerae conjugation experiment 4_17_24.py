@@ -1,141 +1,280 @@
+import argparse
+import mmap
+import os
+import re
 import tkinter as tk
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
 from tkinter import filedialog
-from collections import Counter
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator
 import numpy as np
 
-def select_file(prompt):
+try:
+    from numba import config as numba_config, get_num_threads, njit, prange, set_num_threads
+except ImportError:  # Numba is optional. Without it, count_PAMs scans each file with a regular expression instead.
+    njit = None
+
+SCAN_CHUNK_SIZE = 16 << 20  # Number of bytes of a FASTQ file scanned as one chunk.
+
+# Lookup table mapping each byte to a 2-bit nucleotide code. Any byte other than A, C, G or T (e.g. N) maps to 4.
+NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint8)
+NUCLEOTIDE_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+
+# The 64 PAM sequences in the protospacer libraries, and the same list followed by the empty vector control sequence.
+DNA_BASES = ['A', 'C', 'G', 'T']
+PAM_SEQUENCES = ['AT' + a + b + c for a in DNA_BASES for b in DNA_BASES for c in DNA_BASES]
+POSSIBLE_PAMS = PAM_SEQUENCES + ['GCATG']
+
+# Column labels for the output files, computed once from POSSIBLE_PAMS.
+NON_GCATG_LABELS = tuple(pam[2:5] for pam in POSSIBLE_PAMS if pam != 'GCATG')
+RAW_COUNT_LABELS = tuple('Empty vector control' if pam == 'GCATG' else pam[2:5] for pam in POSSIBLE_PAMS if pam.startswith('AT') or pam == 'GCATG')
+
+# Define PAM groups and their respective colors for the scatter plot.
+PAM_GROUPS = {
+    'hot1': ['ATAAC', 'ATAAT'],
+    'hot2': ['ATATT', 'ATATC'],
+    'medium': ['ATTAC', 'ATCAT', 'ATCAC', 'ATGAT', 'ATTAT', 'ATGAC', 'ATAGC', 'ATAAG', 'ATAGT'],
+    'cool1': ['ATAAA'],
+    'cool2': ['ATAGG'],
+}
+PAM_GROUP_COLORS = {
+    'hot1': 'red',
+    'hot2': 'orange',
+    'medium': 'olive',
+    'cool1': 'darkcyan',
+    'cool2': 'slateblue',
+    'other': 'gray'  # Default color for ungrouped PAMs
+}
+# Color of each grouped PAM, flattened once so that each PAM is a single dictionary lookup.
+PAM_COLOR = {pam: PAM_GROUP_COLORS[group] for group, members in PAM_GROUPS.items() for pam in members}
+
+def select_file(prompt, root):
     """
     Opens a file dialog to select a file based on a given prompt.
     
     Args:
         prompt (str): The prompt displayed in the file dialog.
+        root (tk.Tk): The hidden Tkinter root window that owns the file dialog.
     
     Returns:
         str: The path to the selected file.
     """
-    root = tk.Tk()  # Create a new Tkinter root window.
-    root.withdraw()  # Hide the root window immediately.
     file_path = filedialog.askopenfilename(
+        parent=root,
         title=prompt,
         filetypes=(("FASTQ files", "*.fastq"), ("All files", "*.*"))  # Set filter for FASTQ files and all files.
     )
     return file_path
 
+def encode_PAMs(PAM_bytes):
+    """
+    Packs fixed-length nucleotide sequences into integer indices, using 2 bits per nucleotide.
+
+    Args:
+        PAM_bytes (numpy.ndarray): A uint8 array with one sequence per row.
+
+    Returns:
+        tuple: The index of each sequence, and a boolean mask that is False for sequences containing a base other than A, C, G or T.
+    """
+    codes = NUCLEOTIDE_CODES[PAM_bytes]
+    valid = (codes < 4).all(axis=1)
+    indices = np.zeros(len(codes), dtype=np.intp)
+    for position in range(codes.shape[1]):
+        indices = (indices << 2) | (codes[:, position] & 3)
+    return indices, valid
+
+def scan_extended_PAMs(buffer, anchor, nucleotide_codes, n_chunks):
+    """
+    Tallies the 5 nt extended PAMs that follow the anchor sequence at the start of a line, scanning the buffer in parallel chunks.
+
+    Args:
+        buffer (numpy.ndarray): A uint8 array holding the contents of a FASTQ file.
+        anchor (numpy.ndarray): A uint8 array holding the sequence that precedes the PAM sequences.
+        nucleotide_codes (numpy.ndarray): Lookup table mapping each byte to a 2-bit nucleotide code, or 4 for any other byte.
+        n_chunks (int): Number of chunks to split the buffer into.
+
+    Returns:
+        numpy.ndarray: Counts of each extended PAM, indexed as by encode_PAMs.
+    """
+    anchor_length = len(anchor)
+    chunk_size = (len(buffer) + n_chunks - 1) // n_chunks
+    chunk_counts = np.zeros((n_chunks, 4 ** 5), dtype=np.int64)
+    for chunk in prange(n_chunks):
+        # Each chunk handles the lines that start after a newline inside it, reading past its end when a line crosses the boundary.
+        for i in range(chunk * chunk_size, min((chunk + 1) * chunk_size, len(buffer))):
+            line_start = i + 1
+            if buffer[i] != 10 or line_start + anchor_length + 5 > len(buffer):
+                continue
+            matched = True
+            for j in range(anchor_length):
+                if buffer[line_start + j] != anchor[j]:
+                    matched = False
+                    break
+            if not matched:
+                continue
+            index = 0
+            for j in range(5):
+                code = nucleotide_codes[buffer[line_start + anchor_length + j]]
+                if code > 3:  # Skip PAMs containing an ambiguous base.
+                    matched = False
+                    break
+                index = (index << 2) | code
+            if matched:
+                chunk_counts[chunk, index] += 1
+    return chunk_counts.sum(axis=0)
+
+if njit is not None:
+    scan_extended_PAMs = njit(parallel=True, cache=True)(scan_extended_PAMs)
+
+def read_manifest(manifest_path, prompts):
+    """
+    Reads the paths of the input files from a tab-delimited manifest.
+
+    Args:
+        manifest_path (Path): Path to a manifest with one 'label<TAB>path' row per input file. Relative paths are resolved against the directory of the manifest.
+        prompts (list): The labels expected in the manifest.
+
+    Returns:
+        dict: A dictionary mapping each label in prompts to its file path.
+    """
+    file_paths = {}
+    with open(manifest_path, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) != 2:
+                    raise ValueError(f"{manifest_path}:{line_number}: expected 'label<TAB>path'")
+                label, path = fields
+                file_paths[label] = str(manifest_path.parent / path)
+
+    missing_labels = [prompt for prompt in prompts if prompt not in file_paths]
+    if missing_labels:
+        raise ValueError(f"{manifest_path} has no entry for: {'; '.join(missing_labels)}")
+    return {prompt: file_paths[prompt] for prompt in prompts}
+
 def count_PAMs(filename, possible_PAMs, seq_start='AGGAAACAGCTATGACCATGATTACGCCAAGCTT'): #expected sequence at the start of each read
     """
     Counts occurrences of PAM sequences in a file that start after a specific sequence.
     
     Args:
         filename (str): Path to the file containing sequences.
-        possible_PAMs (list): List of PAM sequences to count.
+        possible_PAMs (list): List of 5 nt PAM sequences to count.
         seq_start (str): The sequence that precedes the PAM sequences.
         
     Returns:
         list: Counts of each PAM in the order they appear in possible_PAMs.
     """
-    with open(filename, 'r') as file:
-        lines = file.read().splitlines()
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:  # An empty file cannot be memory-mapped.
+            return [0 for _ in possible_PAMs]
+        # Memory-map the file instead of reading it. The mapping is released once the array viewing it is no longer referenced.
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):  # Not available on Windows.
+            mm.madvise(mmap.MADV_SEQUENTIAL)  # The file is scanned once from start to end, so let the OS read ahead aggressively.
+        buffer = np.frombuffer(mm, dtype=np.uint8)
+        del mm
+
+    if njit is not None:
+        # Scan the file with the compiled kernel, split into chunks of at most SCAN_CHUNK_SIZE bytes shared between all available threads.
+        anchor = np.frombuffer(seq_start.encode(), dtype=np.uint8)
+        n_chunks = max(get_num_threads(), -(-len(buffer) // SCAN_CHUNK_SIZE))
+        extended_PAM_count = scan_extended_PAMs(buffer, anchor, NUCLEOTIDE_CODES, n_chunks)
+    else:
+        # Matches seq_start at the beginning of a line and captures the PAM sequence that follows directly after it. Includes 2 nt before the actual PAM to account for the empty vector control sequence.
+        # Anchoring on the preceding newline skips the first line of the file, which in a FASTQ file is always a read header.
+        extended_PAM_pattern = re.compile(b'\n' + re.escape(seq_start.encode()) + b'(.{5})')
+        match_length = len(seq_start) + 6
 
-    # Extracting the PAM sequences that follow directly after seq_start in each line. Includes 2 nt before the actual PAM to account for the empty vector control sequence
-    list_of_extended_PAMs = [line[:39][34:] for line in lines if line.startswith(seq_start)]
-    extended_PAM_count = Counter(list_of_extended_PAMs)  # Count each unique PAM sequence.
+        # Scan the file one chunk at a time with the regular expression engine, so that only one chunk's matches are held in memory.
+        extended_PAM_count = np.zeros(4 ** 5, dtype=np.int64)
+        for chunk_start in range(0, len(buffer), SCAN_CHUNK_SIZE):
+            # Matches may run past the end of the chunk, but only those starting inside it fit before endpos.
+            chunk_end = chunk_start + SCAN_CHUNK_SIZE + match_length - 1
+            extended_PAMs = np.frombuffer(b''.join(extended_PAM_pattern.findall(buffer, chunk_start, chunk_end)), dtype=np.uint8).reshape(-1, 5)
 
-    return [extended_PAM_count[pam] for pam in possible_PAMs]
+            # Count each unique PAM sequence, skipping any that contain an ambiguous base.
+            extended_PAM_indices, valid = encode_PAMs(extended_PAMs)
+            extended_PAM_count += np.bincount(extended_PAM_indices[valid], minlength=4 ** 5)
 
-def normalize_data(file_details, possible_PAMs):
+    possible_PAM_indices, possible_valid = encode_PAMs(np.frombuffer(''.join(possible_PAMs).encode(), dtype=np.uint8).reshape(-1, 5))
+    return np.where(possible_valid, extended_PAM_count[possible_PAM_indices], 0).tolist()
+
+def normalize_data(file_details):
     """
     Normalizes raw PAM counts based on comparison between 'active' and 'inactive' CRISPR conditions.
 
     Args:
         file_details (dict): A dictionary mapping descriptive labels to file paths.
-        possible_PAMs (list): A list of all possible PAMs.
 
     Returns:
         tuple: A tuple containing dictionaries for normalized counts, standard deviations, and raw counts.
     """
-    # Load counts for all files, described by 'file_details'.
-    pam_counts = {description: count_PAMs(filename, possible_PAMs) for description, filename in file_details.items()}
-    normalized_counts = {}
+    # Load counts for all files, described by 'file_details'. Each file is counted in a separate process.
+    # The Numba kernel is itself multithreaded, so the available threads are divided between the worker processes to avoid oversubscribing the cores.
+    # The thread count is read from the configuration rather than get_num_threads(), which would start Numba's thread pool in this process before it forks.
+    n_workers = min(len(file_details), os.cpu_count() or 1)
+    worker_options = {}
+    if njit is not None:
+        worker_options = {'initializer': set_num_threads, 'initargs': (max(1, numba_config.NUMBA_NUM_THREADS // n_workers),)}
+    with ProcessPoolExecutor(max_workers=n_workers, **worker_options) as executor:
+        counts = executor.map(partial(count_PAMs, possible_PAMs=POSSIBLE_PAMS), file_details.values())
+        pam_counts = dict(zip(file_details.keys(), counts))
+
+    # Stack the counts for each 'active' sample and its corresponding 'inactive' sample into 2D arrays, one row per sample.
+    active_descriptions = [description for description in file_details if 'active' in description and 'inactive' not in description]
+    active_counts = np.array([pam_counts[description] for description in active_descriptions], dtype=np.float64)
+    inactive_counts = np.array([pam_counts[description.replace('active', 'inactive')] for description in active_descriptions], dtype=np.float64)
 
     # Normalize 'active' counts by their corresponding 'inactive' counts.
-    for description in file_details.keys():
-        if 'active' in description and 'inactive' not in description:
-            inactive_description = description.replace('active', 'inactive')
-            inactive_counts = np.array(pam_counts[inactive_description])
-            active_counts = np.array(pam_counts[description])
-            normalized_counts[description] = active_counts / inactive_counts
-
-    # Normalize further by the 'GCATG' PAM value.
-    for description, counts in normalized_counts.items():
-        gcatg_index = possible_PAMs.index('GCATG')
-        gcatg_value = counts[gcatg_index]
-        normalized_counts[description] = counts / gcatg_value
-
-    # Compute the mean and standard deviation for each PAM.
+    normalized_counts = active_counts / inactive_counts
+
+    # Normalize further by the 'GCATG' PAM value, then drop the 'GCATG' column.
+    gcatg_index = POSSIBLE_PAMS.index('GCATG')
+    normalized_counts /= normalized_counts[:, gcatg_index:gcatg_index + 1]
+    normalized_counts = np.delete(normalized_counts, gcatg_index, axis=1)
+
+    # Group the replicates by spacer, in order of first appearance.
+    spacers = np.array(["Spacer " + description.split(' ')[1].replace(',', '') for description in active_descriptions])
+    spacer_labels = list(dict.fromkeys(spacers.tolist()))
+
+    # Compute the mean and standard deviation for each PAM, with one reduction over the stacked replicates of each spacer. Spacers need not have the same number of replicates.
     average_normalized_counts = {}
     std_devs = {}
-    non_gcatg_indices = list(range(len(possible_PAMs)))
-    non_gcatg_indices.remove(gcatg_index)
-
-    for pam_index in non_gcatg_indices:
-        for description, counts in normalized_counts.items():
-            base_description = "Spacer " + description.split(' ')[1].replace(',', '')
-            if base_description not in average_normalized_counts:
-                average_normalized_counts[base_description] = [[] for _ in non_gcatg_indices]
-                std_devs[base_description] = [[] for _ in non_gcatg_indices]
-            average_normalized_counts[base_description][pam_index].append(counts[pam_index])
-
-    # Calculate averages and standard deviations.
-    for key in average_normalized_counts:
-        averages = []
-        standard_devs = []
-        for pam in average_normalized_counts[key]:
-            averages.append(np.mean(pam))
-            standard_devs.append(np.std(pam))
-        average_normalized_counts[key] = averages
-        std_devs[key] = standard_devs
+    for spacer in spacer_labels:
+        replicates = normalized_counts[spacers == spacer]  # Shape (replicates, PAMs).
+        average_normalized_counts[spacer] = replicates.mean(axis=0).tolist()
+        std_devs[spacer] = replicates.std(axis=0).tolist()
 
     return average_normalized_counts, std_devs, pam_counts
 
-def write_output(average_normalized_counts, possible_PAMs, output_file):
+def write_output(average_normalized_counts, output_file):
     """
     Writes the normalized conjugation efficiencies to an output file.
 
     Args:
-        average_normalized_counts (dict): A dictionary of normalized PAM counts.
-        possible_PAMs (list): A list of PAM sequences.
+        average_normalized_counts (dict): A dictionary of normalized PAM counts, in the order of NON_GCATG_LABELS.
         output_file (str): Path to the output file.
     """
-    non_gcatg_pams = [pam[2:5] for pam in possible_PAMs if pam != "GCATG"]
     with open(output_file, 'w') as f:
         f.write('PAM\tSpacer 4\tSpacer 21\n')
-        for i, pam in enumerate(non_gcatg_pams):
+        for i, pam in enumerate(NON_GCATG_LABELS):
             f.write(f'{pam}\t{average_normalized_counts["Spacer 4"][i]}\t{average_normalized_counts["Spacer 21"][i]}\n')
 
-def write_output_raw_counts(raw_PAM_counts, possible_PAMs, output_file_raw_counts):
+def write_output_raw_counts(raw_PAM_counts, output_file_raw_counts):
     """
     Writes raw PAM counts to a designated output file.
 
     Args:
-        raw_PAM_counts (dict): Raw counts of each PAM sequence.
-        possible_PAMs (list): A list of all possible PAMs.
+        raw_PAM_counts (dict): Raw counts of each PAM sequence, in the order of POSSIBLE_PAMS.
         output_file_raw_counts (str): Path to the raw counts output file.
     """
+    # Build every row as a single tab-delimited string (each ending in a tab) and write the whole table at once.
+    rows = ['\t'.join(['', *RAW_COUNT_LABELS, ''])]
+    rows.extend('\t'.join([label, *map(str, read_coverage), '']) for label, read_coverage in raw_PAM_counts.items())
     with open(output_file_raw_counts, 'w') as f:
-        f.write('\t')
-        for PAM in possible_PAMs:
-            if PAM[0:2] == 'AT':
-                f.write(PAM[2:5] + '\t')
-            elif PAM == 'GCATG':
-                f.write('Empty vector control\t')
-        f.write('\n')
-        for label in raw_PAM_counts:
-            f.write(label + '\t')
-            for read_coverage in raw_PAM_counts[label]:
-                f.write(str(read_coverage) + '\t')
-            f.write('\n')
+        f.write(''.join(row + '\n' for row in rows))
 
 def create_scatter_plot(data, std_devs, output_path, pam_sequences):
     """
@@ -153,38 +292,13 @@ def create_scatter_plot(data, std_devs, output_path, pam_sequences):
     x_errors = std_devs['Spacer 4']
     y_errors = std_devs['Spacer 21']
 
-    # Define PAM groups and their respective colors.
-    pam_groups = {
-        'hot1': ['ATAAC', 'ATAAT'],
-        'hot2': ['ATATT', 'ATATC'],
-        'medium': ['ATTAC', 'ATCAT', 'ATCAC', 'ATGAT', 'ATTAT', 'ATGAC', 'ATAGC', 'ATAAG', 'ATAGT'],
-        'cool1': ['ATAAA'],
-        'cool2': ['ATAGG'],
-    }
-    colors = {
-        'hot1': 'red',
-        'hot2': 'orange',
-        'medium': 'olive',
-        'cool1': 'darkcyan',
-        'cool2': 'slateblue',
-        'other': 'gray'  # Default color for ungrouped PAMs
-    }
-
     # Assign colors based on PAM group membership.
-    point_colors = []
-    for pam in pam_sequences:
-        found = False
-        for group, members in pam_groups.items():
-            if pam in members:
-                point_colors.append(colors[group])
-                found = True
-                break
-        if not found:
-            point_colors.append(colors['other'])
-    
-    # Plot each point with corresponding error bars and colors.
-    for i in range(len(x_data)):
-        plt.errorbar(x_data[i], y_data[i], xerr=x_errors[i], yerr=y_errors[i], fmt='o', color=point_colors[i], ecolor=point_colors[i], elinewidth=1, capsize=2)
+    point_colors = np.array([PAM_COLOR.get(pam, PAM_GROUP_COLORS['other']) for pam in pam_sequences])
+
+    # Plot the points of each color, with their error bars, in a single call per color.
+    for color in dict.fromkeys(point_colors):
+        in_group = point_colors == color
+        plt.errorbar(np.asarray(x_data)[in_group], np.asarray(y_data)[in_group], xerr=np.asarray(x_errors)[in_group], yerr=np.asarray(y_errors)[in_group], fmt='o', color=color, ecolor=color, elinewidth=1, capsize=2)
 
     plt.xlabel('Normalized Conjugation Efficiency\nSpacer 4')
     plt.ylabel('Normalized Conjugation Efficiency\nSpacer 21')
@@ -203,9 +317,6 @@ def main():
     """
     Main function to orchestrate file selection, data processing, and output generation.
     """
-    DNA_bases = ['A', 'C', 'G', 'T']
-    possible_PAMs = ['AT' + a + b + c for a in DNA_bases for b in DNA_bases for c in DNA_bases] + ['GCATG']
-    PAM_sequences = ['AT' + a + b + c for a in DNA_bases for b in DNA_bases for c in DNA_bases]
     prompts = [
         "Spacer 4, CRISPR-inactive, replicate 1",
         "Spacer 4, CRISPR-active, replicate 1",
@@ -217,19 +328,43 @@ def main():
         "Spacer 21, CRISPR-active, replicate 2"
     ]
 
-    file_details = {prompt: select_file(prompt) for prompt in prompts}
-    output_file_raw_counts = filedialog.asksaveasfilename(title='Save output file for raw PAM counts', filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
-    output_file = filedialog.asksaveasfilename(title='Save output file for normalized conjugation efficiencies', filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+    parser = argparse.ArgumentParser(description='Counts PAM sequences in the conjugation experiment .fastq files and calculates normalized conjugation efficiencies.')
+    parser.add_argument('--manifest', type=Path, help="Tab-delimited file with one 'label<TAB>path' row per input .fastq file. Labels must match the input file descriptions, e.g. 'Spacer 4, CRISPR-inactive, replicate 1'. If omitted, each file is selected in a file dialog.")
+    parser.add_argument('--raw-counts-output', help='Path of the output file for raw PAM counts. If omitted, it is selected in a file dialog.')
+    parser.add_argument('--output', help='Path of the output file for normalized conjugation efficiencies. If omitted, it is selected in a file dialog.')
+    args = parser.parse_args()
+    if args.manifest and not args.manifest.is_file():
+        parser.error(f"{args.manifest}: manifest file not found")
+
+    if args.manifest:
+        try:
+            file_details = read_manifest(args.manifest, prompts)
+        except ValueError as error:
+            parser.error(str(error))
+
+    # Create a single hidden Tkinter root window shared by all file dialogs, but only if any dialog is needed.
+    root = None
+    if not (args.manifest and args.raw_counts_output and args.output):
+        root = tk.Tk()
+        root.withdraw()
+
+    if not args.manifest:
+        file_details = {prompt: select_file(prompt, root) for prompt in prompts}
+    output_file_raw_counts = args.raw_counts_output or filedialog.asksaveasfilename(parent=root, title='Save output file for raw PAM counts', filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+    output_file = args.output or filedialog.asksaveasfilename(parent=root, title='Save output file for normalized conjugation efficiencies', filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+
+    if root is not None:
+        root.destroy()
 
     if not output_file.endswith('.txt'):
         output_file += '.txt'
     if not output_file_raw_counts.endswith('.txt'):
         output_file_raw_counts += '.txt'
 
-    average_normalized_counts, std_devs, raw_PAM_counts = normalize_data(file_details, possible_PAMs)
-    write_output(average_normalized_counts, possible_PAMs, output_file)
-    write_output_raw_counts(raw_PAM_counts, possible_PAMs, output_file_raw_counts)
-    create_scatter_plot(average_normalized_counts, std_devs, output_file, PAM_sequences)
+    average_normalized_counts, std_devs, raw_PAM_counts = normalize_data(file_details)
+    write_output(average_normalized_counts, output_file)
+    write_output_raw_counts(raw_PAM_counts, output_file_raw_counts)
+    create_scatter_plot(average_normalized_counts, std_devs, output_file, PAM_SEQUENCES)
 
 if __name__ == "__main__":
     main()